@@ -1,12 +1,50 @@
+import functools
+import logging
+import logging.handlers
+import mmap
 import os
 import shutil
+import sys
+import warnings
+import numpy as np
 import yaml
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    # PyYAML built without libyaml; ~10x slower but same result
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+# Buffer warnings in memory instead of flushing stderr line by line; the
+# buffer is drained in bulk when full, on an ERROR, or at shutdown
+logger = logging.getLogger('combine')
+if not logger.handlers:
+    log_buffer = logging.handlers.MemoryHandler(capacity=10000, flushLevel=logging.ERROR,
+                                                target=logging.StreamHandler())
+    logger.addHandler(log_buffer)
+    logger.setLevel(logging.WARNING)
+else:
+    log_buffer = logger.handlers[0]
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it the scanner runs as plain Python
+    def njit(*args, **kwargs):
+        def wrap(func):
+            return func
+        return wrap
+
+@functools.lru_cache(maxsize=None)
+def load_yaml(path):
+    """Load a yaml file with the C loader, caching repeat reads."""
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=YamlLoader)
 
 def read_classes_from_yaml(data_yaml_path):
     """Read class names from a data.yaml file."""
-    with open(data_yaml_path, 'r') as f:
-        data_yaml = yaml.safe_load(f)
-    classes = data_yaml.get('names', [])
+    classes = load_yaml(data_yaml_path).get('names', [])
     return classes
 
 def write_combined_data_yaml(combined_classes, output_dataset_path):
@@ -16,29 +54,306 @@ def write_combined_data_yaml(combined_classes, output_dataset_path):
         'val': os.path.join(output_dataset_path, 'valid', 'images'),
         'test': os.path.join(output_dataset_path, 'test', 'images'),
         'nc': len(combined_classes),
-        'names': combined_classes
+        'names': list(combined_classes)
     }
     output_yaml_path = os.path.join(output_dataset_path, 'data.yaml')
     with open(output_yaml_path, 'w') as f:
-        yaml.dump(data_yaml, f, default_flow_style=False)
+        yaml.dump(data_yaml, f, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)
 
 def combine_labels(old_label, label_mapping):
     """Map old labels to new labels based on the label_mapping dictionary."""
     return label_mapping.get(old_label, old_label)  # Default to old label if not in mapping
 
-def is_valid_label_line(line, num_classes):
-    """Check if a label line is valid."""
-    elements = line.strip().split()
-    if len(elements) < 5:
-        return False, "Label line does not have at least 5 elements."
+@njit(cache=True)
+def scan_labels(buf, num_classes, lut):
+    """Validate and remap every line of a raw label buffer in one pass.
+
+    buf is the file contents as a uint8 array. Returns (line_starts,
+    line_ends, new_class_ids); new_class_ids[k] is the remapped class ID of
+    line k, or -1 if the line is invalid (not an integer class ID, fewer
+    than 5 fields, non-numeric field, or ID out of range/unmapped).
+    """
+    n = buf.shape[0]
+    num_lines = 0
+    for i in range(n):
+        if buf[i] == 10:
+            num_lines += 1
+    if n > 0 and buf[n - 1] != 10:
+        num_lines += 1
+
+    line_starts = np.empty(num_lines, np.int64)
+    line_ends = np.empty(num_lines, np.int64)
+    new_class_ids = np.full(num_lines, -1, np.int64)
+
+    line = 0
+    i = 0
+    while i < n:
+        start = i
+        while i < n and buf[i] != 10:
+            i += 1
+        end = i
+        i += 1
+        while end > start and (buf[end - 1] == 13 or buf[end - 1] == 32 or buf[end - 1] == 9):
+            end -= 1
+        idx = line
+        line_starts[idx] = start
+        line_ends[idx] = end
+        line += 1
+
+        j = start
+        while j < end and (buf[j] == 32 or buf[j] == 9):
+            j += 1
+        if j >= end:
+            continue
+
+        # Parse the class ID as a plain integer
+        negative = buf[j] == 45
+        if negative:
+            j += 1
+        class_id = 0
+        num_digits = 0
+        while j < end and 48 <= buf[j] <= 57:
+            class_id = class_id * 10 + (buf[j] - 48)
+            num_digits += 1
+            j += 1
+        if num_digits == 0:
+            continue
+        if j < end and buf[j] != 32 and buf[j] != 9:
+            continue
+        if negative:
+            class_id = -class_id
+
+        # Count the remaining fields and check they look numeric
+        num_fields = 1
+        numeric = True
+        while j < end:
+            while j < end and (buf[j] == 32 or buf[j] == 9):
+                j += 1
+            if j >= end:
+                break
+            num_fields += 1
+            while j < end and buf[j] != 32 and buf[j] != 9:
+                c = buf[j]
+                if not (48 <= c <= 57 or c == 46 or c == 45 or c == 43 or c == 101 or c == 69):
+                    numeric = False
+                j += 1
+        if not numeric or num_fields < 5:
+            continue
+
+        if 0 <= class_id < num_classes and class_id < lut.shape[0]:
+            new_class_ids[idx] = lut[class_id]
+
+    return line_starts, line_ends, new_class_ids
+
+def build_class_lut(mapping):
+    """Build a dense numpy lookup table from an {old_id: new_id} mapping.
+
+    Unmapped IDs stay -1, which doubles as the invalid marker during
+    remapping.
+    """
+    if not mapping:
+        # Dataset with an empty names list: every label is unmapped
+        return np.empty(0, dtype=np.int16)
+    lut = np.full(max(mapping) + 1, -1, dtype=np.int16)
+    for old_id, new_id in mapping.items():
+        lut[old_id] = new_id
+    return lut
+
+def remap_label_bytes(buf, lut, num_classes):
+    """Byte-level fallback for label files numpy cannot parse wholesale.
+
+    Rebuilds the file as one bytearray, swapping only the class-ID field
+    and keeping the rest of each valid line verbatim — no per-line
+    split/join/str allocations.
+    """
+    line_starts, line_ends, new_class_ids = scan_labels(np.frombuffer(buf, dtype=np.uint8), num_classes, lut)
+    out = bytearray()
+    invalid_count = 0
+    for k in range(len(new_class_ids)):
+        new_class_id = new_class_ids[k]
+        if new_class_id < 0:
+            invalid_count += 1
+            continue
+        line = bytes(buf[line_starts[k]:line_ends[k]]).lstrip()
+        space = line.find(b' ')
+        tab = line.find(b'\t')
+        if space == -1 or 0 <= tab < space:
+            space = tab
+        out += b'%d' % new_class_id
+        out += line[space:]
+        out += b'\n'
+    return out, invalid_count
+
+def remap_label_file(src_label_path, lut, num_classes):
+    """Validate and remap a whole label file in one vectorized pass.
+
+    Returns (labels, invalid_count). labels is a numpy array with the class
+    column rewritten, or the byte-scanner fallback's rebuilt bytearray when
+    the file is ragged or contains non-numeric fields.
+    """
+    if os.path.getsize(src_label_path) == 0:
+        return bytearray(), 0
     try:
-        class_id = int(elements[0])
-        if not (0 <= class_id < num_classes):
-            return False, f"Class ID {class_id} is out of valid range (0 to {num_classes - 1})."
+        with warnings.catch_warnings():
+            # loadtxt warns to stderr about whitespace-only files; the
+            # empty result is handled below
+            warnings.simplefilter('ignore')
+            arr = np.loadtxt(src_label_path, ndmin=2)
     except ValueError:
-        return False, "Class ID is not an integer."
-    # Additional checks for bounding box coordinates can be added here if needed
-    return True, ""
+        # Map the file instead of copying it into a bytes object; the
+        # scanner reads straight out of the page cache
+        with open(src_label_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return remap_label_bytes(mm, lut, num_classes)
+    if arr.size == 0:
+        return bytearray(), 0
+    if arr.shape[1] < 5:
+        return bytearray(), arr.shape[0]
+    class_ids = arr[:, 0]
+    new_class_ids = np.full(arr.shape[0], -1, dtype=np.int64)
+    in_range = (class_ids >= 0) & (class_ids < num_classes) & (class_ids == class_ids.astype(np.int64)) & (class_ids < len(lut))
+    new_class_ids[in_range] = lut[class_ids[in_range].astype(np.int64)]
+    keep = new_class_ids >= 0
+    arr = arr[keep]
+    arr[:, 0] = new_class_ids[keep]
+    return arr, int((~keep).sum())
+
+try:
+    import fcntl
+    FICLONE = 0x40049409  # linux/fs.h: share src's extents copy-on-write
+except ImportError:
+    fcntl = None
+
+if sys.platform == 'darwin':
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno=True)
+
+def reflink(src, dst):
+    """Copy-on-write clone of src at dst, in-process.
+
+    FICLONE ioctl on Linux, clonefile on macOS/APFS; raises OSError where
+    the filesystem (or a cross-filesystem pair) doesn't support cloning.
+    """
+    if sys.platform == 'darwin':
+        if _libc.clonefile(src.encode(), dst.encode(), 0) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dst)
+        return
+    if fcntl is None:
+        raise OSError('reflink not supported on this platform')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def index_dataset(dataset_path, splits):
+    """Walk a dataset once and index its files by split and kind.
+
+    Returns {(split, 'images'|'labels'): {filename: path}}, so the
+    processing loop needs no further directory scans or exists() calls.
+    """
+    index = {}
+    for dirpath, _, filenames in os.walk(dataset_path, followlinks=False):
+        kind = os.path.basename(dirpath)
+        split = os.path.basename(os.path.dirname(dirpath))
+        if kind not in ('images', 'labels') or split not in splits:
+            continue
+        bucket = index.setdefault((split, kind), {})
+        for name in filenames:
+            bucket[name] = os.path.join(dirpath, name)
+    return index
+
+def fastcopy(src, dst):
+    """Copy a file without pushing its bytes through userspace if possible.
+
+    The source datasets are read-only, so a hard link is enough; failing
+    that, try a copy-on-write reflink clone, then fall back to a real copy.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        reflink(src, dst)
+        return
+    except OSError:
+        pass
+    # Different filesystem: transfer the bytes in-kernel with
+    # copy_file_range/sendfile instead of a userspace read/write loop
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            if hasattr(os, 'copy_file_range'):
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            elif hasattr(os, 'sendfile'):
+                while copied < size:
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            if copied == size:
+                return
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+
+def process_one(args):
+    """Copy one image and rewrite its label file. Runs in a worker process.
+
+    Returns (dataset_path, split, counts, warning_msgs) so the parent can
+    update the summary dict and log the warnings; workers exit via
+    os._exit, which would drop anything left in their own log buffer.
+    """
+    (dataset_idx, dataset_path, split, img_file,
+     src_img_path, src_label_path, images_output_dir, labels_output_dir,
+     lut, num_classes) = args
+
+    counts = {'images': 0, 'labels': 0, 'missing_labels': 0, 'invalid_labels': 0}
+    warning_msgs = []
+
+    if src_label_path is None:
+        warning_msgs.append(f"No label file found for image '{img_file}' in dataset '{dataset_path}', split '{split}'. Skipping this image.")
+        counts['missing_labels'] += 1
+        return dataset_path, split, counts, warning_msgs
+
+    # Sanity check and class remap in one vectorized pass
+    valid_labels, invalid_count = remap_label_file(src_label_path, lut, num_classes)
+    if invalid_count:
+        warning_msgs.append(f"{invalid_count} invalid label line(s) skipped in '{src_label_path}'.")
+        counts['invalid_labels'] += invalid_count
+
+    if len(valid_labels) == 0:
+        warning_msgs.append(f"No valid labels found for image '{img_file}' in dataset '{dataset_path}', split '{split}'. Skipping this image.")
+        counts['invalid_labels'] += 1
+        return dataset_path, split, counts, warning_msgs
+
+    # Copy image file
+    dst_img_filename = f"{dataset_idx}_{split}_{img_file}"
+    dst_img_path = os.path.join(images_output_dir, dst_img_filename)
+    fastcopy(src_img_path, dst_img_path)
+    counts['images'] += 1
+
+    # Write new label file
+    dst_label_filename = os.path.splitext(dst_img_filename)[0] + '.txt'
+    dst_label_path = os.path.join(labels_output_dir, dst_label_filename)
+    if isinstance(valid_labels, np.ndarray):
+        # Buffer the whole label file and flush it in one write
+        with open(dst_label_path, 'wb', buffering=1 << 20) as f:
+            np.savetxt(f, valid_labels, fmt=['%d'] + ['%.6f'] * (valid_labels.shape[1] - 1))
+    else:
+        # The fallback already assembled the file bytes; dump them raw
+        fd = os.open(dst_label_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, valid_labels)
+        finally:
+            os.close(fd)
+    counts['labels'] += 1
+
+    return dataset_path, split, counts, warning_msgs
 
 def combine_datasets(dataset_paths, output_dataset_path):
     """
@@ -66,16 +381,16 @@ def combine_datasets(dataset_paths, output_dataset_path):
         # Other labels remain as they are
     }
 
-    # Step 1: Build combined class list and class mappings
-    combined_classes = []
+    # Step 1: Build combined class list and class mappings.
+    # combined_classes maps class name -> new class ID; dicts keep insertion
+    # order, so the names double as the ordered class list.
+    combined_classes = {}
     class_mappings = []  # List of dicts for mapping old class IDs to new IDs per dataset
 
     for dataset_idx, dataset_path in enumerate(dataset_paths):
         data_yaml_path = os.path.join(dataset_path, 'data.yaml')
         if os.path.exists(data_yaml_path):
-            with open(data_yaml_path, 'r') as f:
-                data_yaml = yaml.safe_load(f)
-            dataset_classes = data_yaml.get('names', [])
+            dataset_classes = read_classes_from_yaml(data_yaml_path)
         else:
             # If data.yaml does not exist, we can't proceed
             raise FileNotFoundError(f"data.yaml file not found in dataset: {dataset_path}")
@@ -84,12 +399,13 @@ def combine_datasets(dataset_paths, output_dataset_path):
         for idx, class_name in enumerate(dataset_classes):
             # Map old label to new label
             new_label = combine_labels(class_name, label_mapping)
-            if new_label not in combined_classes:
-                combined_classes.append(new_label)
-            new_class_id = combined_classes.index(new_label)
-            mapping[idx] = new_class_id
+            mapping[idx] = combined_classes.setdefault(new_label, len(combined_classes))
         class_mappings.append(mapping)
 
+    # Dense per-dataset lookup tables, built once so the per-file remap is
+    # a single array indexing operation
+    class_luts = [build_class_lut(mapping) for mapping in class_mappings]
+
     num_classes = len(combined_classes)
 
     # Create output directories
@@ -101,84 +417,50 @@ def combine_datasets(dataset_paths, output_dataset_path):
         os.makedirs(labels_output_dir, exist_ok=True)
 
     # Write combined data.yaml to output dataset
-    write_combined_data_yaml(combined_classes, output_dataset_path)
+    write_combined_data_yaml(list(combined_classes), output_dataset_path)
 
     # Initialize counters for summary
     summary = {dataset_path: {split: {'images': 0, 'labels': 0, 'missing_labels': 0, 'invalid_labels': 0} for split in splits} for dataset_path in dataset_paths}
 
-    # Step 2: Process and copy images and labels for each split
+    # Step 2: Process and copy images and labels for each split.
+    # The per-image work (copy + parse + rewrite) is independent, so fan it
+    # out across cores with a process pool.
+    tasks = []
     for dataset_idx, dataset_path in enumerate(dataset_paths):
-        mapping = class_mappings[dataset_idx]
+        lut = class_luts[dataset_idx]
+        # One walk over the dataset replaces the per-split listdir/exists calls
+        dataset_index = index_dataset(dataset_path, splits)
 
         for split in splits:
-            # Default directories
-            images_dir = os.path.join(dataset_path, split, 'images')
-            labels_dir = os.path.join(dataset_path, split, 'labels')
+            image_files = dataset_index.get((split, 'images'))
+            label_files = dataset_index.get((split, 'labels'))
 
-            # Check if directories exist
-            if not os.path.exists(images_dir):
-                print(f"No images directory found for split '{split}' in dataset: {dataset_path}")
+            if image_files is None:
+                logger.warning(f"No images directory found for split '{split}' in dataset: {dataset_path}")
                 continue
-            if not os.path.exists(labels_dir):
-                print(f"No labels directory found for split '{split}' in dataset: {dataset_path}")
+            if label_files is None:
+                logger.warning(f"No labels directory found for split '{split}' in dataset: {dataset_path}")
                 continue
 
             images_output_dir = os.path.join(output_dataset_path, split, 'images')
             labels_output_dir = os.path.join(output_dataset_path, split, 'labels')
 
-            image_files = [f for f in os.listdir(images_dir) if os.path.isfile(os.path.join(images_dir, f))]
-            for img_file in image_files:
-                src_img_path = os.path.join(images_dir, img_file)
-                # Corresponding label file
+            for img_file, src_img_path in image_files.items():
                 label_filename = os.path.splitext(img_file)[0] + '.txt'
-                src_label_path = os.path.join(labels_dir, label_filename)
-
-                if not os.path.exists(src_label_path):
-                    print(f"Warning: No label file found for image '{img_file}' in dataset '{dataset_path}', split '{split}'. Skipping this image.")
-                    summary[dataset_path][split]['missing_labels'] += 1
-                    continue
-
-                # Sanity check for label file
-                with open(src_label_path, 'r') as f:
-                    label_lines = f.readlines()
-
-                valid_label_lines = []
-                for line_num, line in enumerate(label_lines, start=1):
-                    is_valid, error_message = is_valid_label_line(line, num_classes)
-                    if not is_valid:
-                        print(f"Warning: Invalid label in '{src_label_path}' at line {line_num}: {error_message}")
-                        summary[dataset_path][split]['invalid_labels'] += 1
-                        continue  # Skip invalid label line
-
-                    # Process label line
-                    elements = line.strip().split()
-                    old_class_id = int(elements[0])
-                    if old_class_id in mapping:
-                        new_class_id = mapping[old_class_id]
-                        # Replace old class ID with new class ID
-                        new_line = ' '.join([str(new_class_id)] + elements[1:])
-                        valid_label_lines.append(new_line)
-                    else:
-                        print(f"Warning: Class ID {old_class_id} not in mapping for dataset '{dataset_path}'. Skipping this label.")
-                        summary[dataset_path][split]['invalid_labels'] += 1
-
-                if not valid_label_lines:
-                    print(f"Warning: No valid labels found for image '{img_file}' in dataset '{dataset_path}', split '{split}'. Skipping this image.")
-                    summary[dataset_path][split]['invalid_labels'] += 1
-                    continue
-
-                # Copy image file
-                dst_img_filename = f"{dataset_idx}_{split}_{img_file}"
-                dst_img_path = os.path.join(images_output_dir, dst_img_filename)
-                shutil.copy(src_img_path, dst_img_path)
-                summary[dataset_path][split]['images'] += 1
-
-                # Write new label file
-                dst_label_filename = os.path.splitext(dst_img_filename)[0] + '.txt'
-                dst_label_path = os.path.join(labels_output_dir, dst_label_filename)
-                with open(dst_label_path, 'w') as f:
-                    f.write('\n'.join(valid_label_lines))
-                summary[dataset_path][split]['labels'] += 1
+                tasks.append((dataset_idx, dataset_path, split, img_file,
+                              src_img_path, label_files.get(label_filename),
+                              images_output_dir, labels_output_dir,
+                              lut, num_classes))
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for dataset_path, split, counts, warning_msgs in executor.map(process_one, tasks, chunksize=64):
+            for msg in warning_msgs:
+                logger.warning(msg)
+            for key, value in counts.items():
+                summary[dataset_path][split][key] += value
+
+    # Drain any buffered warnings before the summary goes out
+    log_buffer.flush()
 
     # Print summary of file counts for each dataset and split
     print("\nSummary of files in each dataset and split:")